@@ -6,16 +6,32 @@
 # Outputs to Std Output (see -h)
 
 import polars as pl
+import gzip as gz
 import argparse
 import sys
 
-def get_names(vcf_path):
-    with open(vcf_path, "rt") as ifile:
-        for line in ifile:
-            if line.startswith("#CHROM"):
-                vcf_names = [x for x in line.split('\t')]
+def get_names(vcf_path, gzip=False):
+    # Reads the header in chunks of 1 MiB until the end of the "#CHROM" line is found. Only the new data is
+    # searched, and before "#CHROM" is found only a tail long enough to match it across chunks is kept
+    buf = bytearray(b'\n')
+    start = end = -1
+    with (gz.open(vcf_path, "rb") if gzip else open(vcf_path, "rb")) as ifile:
+        while end < 0:
+            chunk = ifile.read(1 << 20)
+            if not chunk:
                 break
-    ifile.close()
+            if start < 0:
+                del buf[:-len(b'\n#CHROM')]
+                buf += chunk
+                start = buf.find(b'\n#CHROM')
+                end = buf.find(b'\n', start+1) if start >= 0 else -1
+            else:
+                pos = len(buf)
+                buf += chunk
+                end = buf.find(b'\n', pos)
+    if start < 0:
+        raise ValueError(f"No #CHROM header line found in {vcf_path}")
+    vcf_names = buf[start+1:end if end >= 0 else None].decode().split('\t')
     ll=[]
     for name in vcf_names:
         if '#' in name:
@@ -27,35 +43,42 @@ def get_names(vcf_path):
 
 
 
-def parse_dataframe(myfile):
+def parse_dataframe(myfile, gzip=False):
 
-    names = get_names(myfile)
+    names = get_names(myfile, gzip=gzip)
 
-    df = pl.scan_csv(myfile, comment_prefix='#', separator="\t", has_header=False,)
-    cols = df.collect_schema().names()
-    df = df.rename(dict(zip(cols,names)))
+    # Reads (lazy) vcf file, gzipped files are decompressed by polars. All columns are strings but POS (no type inference)
+    schema = {f"column_{i+1}":pl.Int64 if i==1 else pl.String for i in range(len(names))}
+    df = pl.scan_csv(myfile, comment_prefix='#', separator="\t", has_header=False, schema=schema, infer_schema_length=0, low_memory=True, rechunk=False)
+    # Polars names the columns "column_1", "column_2", ... when there is no header
+    df = df.rename({f"column_{i+1}":name for i,name in enumerate(names)})
 
     idx = names.index('FORMAT')
     inds = names[idx+1:]
 
-    df = df.select(pl.col(x) for x in inds).with_columns( pl.col(x).str.split(':').list.first() for x in inds)
-    dfu = df.unpivot()
-    dfu = dfu.with_columns(
-            pl.when(pl.col("value") == './.')
-            .then(0)
-            .when(pl.col("value").str.split('/').list.n_unique() > 1)
-            .then(2)
-            .otherwise(1).alias("value")).group_by(
-            ['variable','value']).len().collect()
-
-    dfu = dfu.pivot("value", index="variable", values="len").sort('variable').rename({'2':'#het','1':'#hom','0':'#NAs','variable':'individuals'})
+    def count_genotypes(x):
+        # Alleles are compared as bytes of the genotype, works for unphased ("0/1") and phased ("0|1") genotypes.
+        # A genotype is missing only when all its alleles are missing ("./.", ".|.", "."), half-missing genotypes
+        # ("0/.", "./0") are heterozygous whatever the order of the alleles
+        a1 = pl.col(x).str.slice(0,1)
+        a2 = pl.col(x).str.slice(2,1)
+        nas = ((a1 == '.') & ((a2 == '.') | (a2 == ''))).sum()
+        het = ((a2 != '') & (a1 != a2)).sum()
+        return [nas.alias(x+'#NAs'), het.alias(x+'#het'), (pl.len() - nas - het).alias(x+'#hom')]
+
+    # Counts the genotypes of every sample in a single pass (one row with three columns per sample)
+    df = df.select(pl.col(x) for x in inds).with_columns( pl.col(x).str.split_exact(':', 0).struct.field('field_0').alias(x) for x in inds)
+    counts = df.select(e for x in inds for e in count_genotypes(x)).collect(streaming=True)
+
+    dfu = pl.DataFrame({'individuals':inds, **{c:[counts[x+c].item() for x in inds] for c in ['#het','#hom','#NAs']}}).sort('individuals')
     dfu = dfu.with_columns((pl.col('#het') + pl.col('#hom')).alias('#call'))
     return dfu
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='A Python script to count heterogocity and call rate from a VCF dataframe')
     parser.add_argument('filename', help='The path of the VCF file')           # positional argument
+    parser.add_argument('-gz','--gzip', help='Boolean to indicate whether vcf file is gunzip compressed or not (default False)',action='store_true')
     args = vars(parser.parse_args())
 
-    df = parse_dataframe(args['filename'], )
+    df = parse_dataframe(args['filename'], gzip=args['gzip'])
     df.write_csv(sys.stdout, separator='\t')
\ No newline at end of file
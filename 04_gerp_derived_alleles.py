@@ -10,116 +10,306 @@ Author: Jesús Castrejón
 
 (tested with polars==1.5)
 
-Usage (gunzipped vcf):
-    python3 gerp_derived_alleles.py -gz -g gerp_file -v vcf_file_gzipped -c contig -s start_position -e end_position -o out_file_name 
+The vcf file must be bgzipped and tabix-indexed (e.g. bgzip vcf_file && tabix -p vcf vcf_file.gz), so that only 
+the rows of the window are read from it.
+The gerp file is converted to parquet (gerp_file.parquet) on first use, and the parquet file is read afterwards. 
+If the parquet file can not be written (read-only directory, no space left) or another job is converting it, the gerp file 
+is read (with a warning). A lock file (gerp_file.parquet.lock) left by a killed job is removed once it is stale.
+If the gerp file is bgzipped and tabix-indexed instead (e.g. bgzip gerp_file && tabix -s1 -b2 -e2 gerp_file.gz), 
+only the rows of the window are read from it and no parquet file is written.
 
-Usage (unzipped vcf):
-    python3 gerp_derived_alleles.py -g gerp_file -v vcf_file_unzipped -c contig -s start_position -e end_position -o out_file_name 
+Usage:
+    python3 gerp_derived_alleles.py -g gerp_file -v vcf_file_bgzipped -c contig -s start_position -e end_position -o out_file_name 
+
+Usage (many windows from a bed file, processed in parallel and written to out_prefix_contig_start_end.tsv):
+    python3 gerp_derived_alleles.py -g gerp_file -v vcf_file_bgzipped -b windows_bed -t threads -o out_prefix 
 """
 
 import polars as pl
-import gzip as gz
+import numpy as np
+import pysam
+import io
+import os
+import time
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import argparse
 
-def read_gerp_windows(gerpFile, chrom, start, end):
-    schema={'column_1':pl.String,'column_2':pl.Int64,'column_3':pl.String,'column_4':pl.Float64}
-    names=['#CHROM','POS','ancestral_state','gerp_score']
-    cols = ['column_1', 'column_2', 'column_3', 'column_4',]
+GERP_SCHEMA = {'column_1':pl.String,'column_2':pl.Int64,'column_3':pl.String,'column_4':pl.Float64}
+GERP_NAMES = dict(zip(GERP_SCHEMA, ['#CHROM','POS','ancestral_state','gerp_score']))
 
-    # Reads (lazy) gerp file and filters positions
-    df = pl.scan_csv(gerpFile,separator='\t',has_header=False, schema=schema).rename(dict(zip(cols,names)))
-    df = df.filter((pl.col("#CHROM") == chrom) & (pl.col("POS").is_between(start, end) ) ).collect()
+# Age (in seconds) after which the lock file of a gerp parquet conversion is considered stale
+GERP_LOCK_MAX_AGE = 24*3600
+# Gerp files whose parquet conversion failed (e.g. no space left on device), not retried for every window
+gerp_parquet_failed = set()
 
-    # Add a row with "NaN" in case the window is missing from the file
-    if len(df)==0:
-        df = pl.DataFrame({"#CHROM": chrom, 'POS':start,'ancestral_state':float("nan"),'gerp_score':float("nan")})
-    return df
+def gerp_lock_is_stale(lock_path):
+    # The lock file contains the host and pid of the job converting the file. It is stale if it is too old,
+    # or if that job (on this host) is not running anymore, e.g. it was killed at the time limit of a cluster
+    try:
+        if time.time() - os.path.getmtime(lock_path) > GERP_LOCK_MAX_AGE:
+            return True
+        with open(lock_path) as f:
+            host, pid = f.read().split()
+    except (OSError, ValueError):
+        return False
+    if host != socket.gethostname():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
 
-def read_vcf_windows(vcf_path, chrom, start, end, gzip=True):
-    def get_names(vcf_path, gzip,):
-        ifile = gz.open(vcf_path, "rt") if gzip else open(vcf_path, "rt")
-        with ifile:
-              for line in ifile:
-                if line.startswith("#CHROM"):
-                    vcf_names = [x for x in line.split('\t')]
-                    break
-        ifile.close()
-        return [x.split('\n')[0] if '\n' in x else x for x in vcf_names]
+def gerp_lock(lock_path):
+    # Creates the lock file atomically, so only one job converts the file. A stale lock file is removed (once)
+    for attempt in range(2):
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if attempt == 0 and gerp_lock_is_stale(lock_path):
+                print(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), "Warning: removing stale lock file", lock_path)
+                try:
+                    os.remove(lock_path)
+                except FileNotFoundError:
+                    pass
+            continue
+        with os.fdopen(fd, 'w') as f:
+            f.write(f"{socket.gethostname()} {os.getpid()}\n")
+        return True
+    return False
+
+def gerp_parquet(gerpFile):
+    # Converts (once) the gerp file to parquet, its row group statistics allow to skip the rows outside each window.
+    # Returns None (the gerp file is read instead) if the parquet file can not be written or another job is converting it
+    parquet_path = gerpFile + '.parquet'
+    def is_converted():
+        return os.path.exists(parquet_path) and os.path.getmtime(parquet_path) >= os.path.getmtime(gerpFile)
+    if is_converted():
+        return parquet_path
+    if gerpFile in gerp_parquet_failed:
+        print(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), f"Warning: no parquet file for {gerpFile} (conversion failed), the gerp file is read instead")
+        return None
+
+    lock_path = parquet_path + '.lock'
+    try:
+        locked = gerp_lock(lock_path)
+    except OSError as e:
+        print(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), f"Warning: the parquet file can not be written ({e}), the gerp file is read instead")
+        return None
+    if not locked:
+        print(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), f"Warning: {gerpFile} is being converted by another job ({lock_path}), the gerp file is read instead")
+        return None
+
+    # Written to a temporary file first, so other jobs never read a partial parquet file
+    tmp_path = f"{parquet_path}.{os.getpid()}.tmp"
+    try:
+        # Another job may have finished the conversion before the lock was taken
+        if is_converted():
+            return parquet_path
+        df = pl.scan_csv(gerpFile,separator='\t',has_header=False, schema=GERP_SCHEMA).rename(GERP_NAMES)
+        df.sink_parquet(tmp_path, row_group_size=1_000_000, statistics=True)
+        os.replace(tmp_path, parquet_path)
+    except (OSError, pl.exceptions.PolarsError) as e:
+        gerp_parquet_failed.add(gerpFile)
+        print(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), f"Warning: conversion of {gerpFile} to parquet failed ({e}), the gerp file is read instead")
+        return None
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        # The lock may already be gone, if two jobs removed the same stale lock at once
+        try:
+            os.remove(lock_path)
+        except FileNotFoundError:
+            pass
+    print(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), "GERP output file converted to", parquet_path)
+    return parquet_path
+
+contigs_cache = {}
+
+def get_contigs(path, tbx):
+    # Contig names of the tabix index as a set, built once per file (tbx.contigs builds a new list on every call)
+    if path not in contigs_cache:
+        contigs_cache[path] = set(tbx.contigs)
+    return contigs_cache[path]
 
-    names = get_names(vcf_path,gzip=gzip,) 
+def read_gerp_windows(gerpFile, chrom, start, end, tbx=None):
+    # Bgzipped and tabix-indexed gerp file: random access (tabix) to the window, no parquet file is needed.
+    # An already open TabixFile can be given to avoid opening the file and its index for every window
+    if os.path.exists(gerpFile + '.tbi'):
+        schema={'#CHROM':pl.String,'POS':pl.Int64,'ancestral_state':pl.String,'gerp_score':pl.Float64}
+        ifile = pysam.TabixFile(gerpFile) if tbx is None else tbx
+        rows = list(ifile.fetch(chrom, start-1, end)) if chrom in get_contigs(gerpFile, ifile) else []
+        if tbx is None:
+            ifile.close()
+        if len(rows)==0:
+            return pl.LazyFrame(schema=schema)
+        return pl.read_csv(io.BytesIO('\n'.join(rows).encode()), separator='\t', has_header=False, schema=schema).lazy()
+
+    # Reads (lazy) gerp parquet file and filters positions, the filter is pushed down to the reader
+    parquet_path = gerp_parquet(gerpFile)
+    if parquet_path is not None:
+        df = pl.scan_parquet(parquet_path)
+        return df.filter((pl.col("#CHROM") == chrom) & (pl.col("POS").is_between(start, end) ) )
+
+    # No parquet file: reads (lazy) gerp file and filters positions before renaming
+    df = pl.scan_csv(gerpFile,separator='\t',has_header=False, schema=GERP_SCHEMA, rechunk=False)
+    return df.filter((pl.col("column_1") == chrom) & (pl.col("column_2").is_between(start, end) ) ).rename(GERP_NAMES)
+
+vcf_names_cache = {}
+
+def get_names(vcf_path):
+    # The header is parsed (once per vcf file) by htslib, only the header block of the file is decompressed
+    if vcf_path not in vcf_names_cache:
+        with pysam.VariantFile(vcf_path) as vf:
+            vcf_names_cache[vcf_path] = ['#CHROM','POS','ID','REF','ALT','QUAL','FILTER','INFO','FORMAT'] + list(vf.header.samples)
+    return vcf_names_cache[vcf_path]
+
+def read_vcf_windows(vcf_path, chrom, start, end, tbx=None):
+    # Random access (tabix) to the window, only the rows of the window are decompressed and read.
+    # An already open TabixFile can be given to avoid opening the file and its index for every window
+    ifile = pysam.TabixFile(vcf_path) if tbx is None else tbx
+    names = get_names(vcf_path)
+    rows = list(ifile.fetch(chrom, start-1, end)) if chrom in get_contigs(vcf_path, ifile) else []
+    if tbx is None:
+        ifile.close()
     inds = names[names.index('FORMAT')+1:]
 
-    if(gzip):
-        # Reads (in-memory) vcf file
-        with gz.open(vcf_path, "rt") as f:   
-            df = pl.read_csv(f,comment_prefix='#', separator="\t", has_header=False,)
-        f.close()
-        # Filters by position
-        df = df.filter((pl.col("column_1") == chrom) & (pl.col("column_2").is_between(start, end) ) )
-    else:
-        # Reads (lazy) vcf file
-        df = pl.scan_csv(vcf_path,comment_prefix='#', separator="\t", has_header=False,)
-        # Filters by position
-        df = df.filter((pl.col("column_1") == chrom) & (pl.col("column_2").is_between(start, end) ) ).collect()
-    
-    cols = df.collect_schema().names()
-    df = df.rename(dict(zip(cols,names)))
-
-    # Fix the genotype column to only contain data until the first ":" and drop unused columns
-    df = df.with_columns( pl.col(x).str.split(':').list.first() for x in inds).drop(["ID","QUAL","FILTER","INFO","FORMAT"])
-    # Add a row with "NaN" in case the window is missing from the file
-    if len(df)==0:
-        d1 = {"#CHROM": chrom, 'POS':start,}
-        d1.update({c:float("nan") for c in names[2:]})
-        df = pl.DataFrame(d1)
+    # Empty (lazy) dataframe in case the window is missing from the file
+    if len(rows)==0:
+        return pl.LazyFrame(schema={"#CHROM":pl.String, 'POS':pl.Int64, 'REF':pl.String, 'ALT':pl.String, **{x:pl.String for x in inds}})
+
+    # Reads (in-memory) the rows of the window, with all columns as strings but POS (no type inference)
+    schema = {f"column_{i+1}":pl.Int64 if i==1 else pl.String for i in range(len(names))}
+    df = pl.read_csv(io.BytesIO('\n'.join(rows).encode()),comment_prefix='#', separator="\t", has_header=False, schema=schema, infer_schema_length=0, low_memory=True, rechunk=False)
+    # Polars names the columns "column_1", "column_2", ... when there is no header
+    df = df.rename({f"column_{i+1}":name for i,name in enumerate(names)})
+
+    # Fix the genotype column to only contain data until the first ":" (without allocating a list per genotype) and drop unused columns
+    df = df.lazy().with_columns( pl.col(x).str.split_exact(':', 0).struct.field('field_0').alias(x) for x in inds).drop(["ID","QUAL","FILTER","INFO","FORMAT"])
     return df
 
-def count_derived_alleles(gerp_path,vcf_path,chrom, start, end, gzip=False):
-    # Loads GERP and VCF files into dataframes
-    df_gerp = read_gerp_windows(gerp_path, chrom, start, end)
-    df_vcf  = read_vcf_windows(vcf_path, chrom, start, end, gzip=gzip)
+# Number of samples from which the derived alleles are counted with numpy instead of polars expressions
+NUMPY_MIN_SAMPLES = 1000
+# Number of genotypes (sites x samples) processed at once by the numpy kernel, bounds its temporary memory
+NUMPY_BATCH_GENOTYPES = 1 << 22
+
+def count_derived_alleles_numpy(df, inds):
+    def derived_alleles(batch):
+        # Genotypes of all samples as a (sites, samples, 3) byte matrix, each genotype padded (or cut) to 3 bytes
+        gts = batch.select(pl.concat_str([pl.col(x).fill_null('.').str.slice(0,3).str.pad_end(3) for x in inds]).str.join('').cast(pl.Binary)).item()
+        gts = np.frombuffer(gts, dtype=np.uint8).reshape(len(batch), len(inds), 3)
+
+        # Allele ("0" for REF, "1" for ALT) that is different to ancestral allele (0 when the ancestral state is missing),
+        # and sites with unknown ancestral state
+        num_ancestral = np.where(batch.select((pl.col('ancestral_state')==pl.col('REF')).fill_null(False)).to_series().to_numpy(), ord('1'), ord('0'))
+        unknown = batch.select((pl.col('ancestral_state')=='N').fill_null(False)).to_series().to_numpy()
+
+        derived = (gts[:,:,0]==num_ancestral[:,None]).astype(np.float64) + (gts[:,:,2]==num_ancestral[:,None])
+        derived[(gts==ord('.')).any(axis=2) | unknown[:,None]] = np.nan
+        return batch.select(['#CHROM','POS','ancestral_state','gerp_score']).hstack(pl.from_numpy(derived, schema=[x+'_no_derived_alleles' for x in inds], orient='row'))
+
+    # The sites are processed in batches, so only one batch of genotypes is held as numpy arrays at a time
+    n_rows = max(1, NUMPY_BATCH_GENOTYPES // len(inds))
+    return pl.concat([derived_alleles(batch) for batch in df.iter_slices(n_rows)] or [derived_alleles(df)], rechunk=False)
+
+def count_derived_alleles(gerp_path,vcf_path,chrom, start, end, tbx=None, gerp_tbx=None):
+    def derived_alleles(x):
+        # Allele (0 for REF, 1 for ALT) that is different to ancestral allele (0 when the ancestral state is missing)
+        num_ancestral = (pl.col('ancestral_state')==pl.col('REF')).fill_null(False).cast(pl.Int8)
+        # Alleles are parsed from the genotype ("0/1", "1|1", ...) and compared as small integers (haploid genotypes have no second allele)
+        a1 = pl.col(x).str.slice(0,1).cast(pl.Int8, strict=False)
+        a2 = pl.col(x).str.slice(2,1).cast(pl.Int8, strict=False)
+        return (a1==num_ancestral).cast(pl.Int8) + (a2==num_ancestral).cast(pl.Int8).fill_null(0)
+
+    # Loads (lazy) GERP and VCF files into dataframes
+    df_gerp = read_gerp_windows(gerp_path, chrom, start, end, tbx=gerp_tbx)
+    df_vcf  = read_vcf_windows(vcf_path, chrom, start, end, tbx=tbx)
 
-    names = df_vcf.columns
+    names = df_vcf.collect_schema().names()
     inds = names[names.index('ALT')+1:]
 
-    # Join GERP and VCFs for each window, and drops null rows
-    df = df_gerp.join(df_vcf, on=['#CHROM','POS'], how='left').drop_nulls(pl.col('REF'))
-    del df_gerp, df_vcf #Drops unused DFs from memory
-    print(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), "GERP output file and VCF file successfully joined for chromosome", chrom, "from position", start, "to position", end)
+    # Join (lazy) GERP and VCFs for each window, only the sites present in both files are kept
+    df = df_gerp.join(df_vcf, on=['#CHROM','POS'], how='inner')
 
-    ### Creates temp column find number of alleles different to ancestral allele
-    df = df.with_columns(pl.when(pl.col('ancestral_state')==pl.col('REF')).then(pl.lit('1')).otherwise(pl.lit('0')).alias('num_ancestral'))
+    # Many samples: the derived alleles are counted on a byte matrix with numpy, batch by batch
+    if len(inds) >= NUMPY_MIN_SAMPLES:
+        schema = {'#CHROM':pl.String,'POS':pl.Int64,'ancestral_state':pl.String,'gerp_score':pl.Float64, **{x+'_no_derived_alleles':pl.Float64 for x in inds}}
+        return df.map_batches(lambda batch: count_derived_alleles_numpy(batch, inds), schema=schema, streamable=True)
+
+    # Number of derived alleles per sample, "NaN" for missing genotypes or unknown ancestral state
     df = df.with_columns(
             pl.when(
-                pl.col(x).str.contains(r'\.'))
+                pl.col(x).str.contains('.', literal=True))
                 .then(float("nan"))
                 .when(pl.col('ancestral_state')=='N')
                 .then(float("nan"))
                 .when( pl.col(x).is_null() )
                 .then(float("nan"))
-                .otherwise(  pl.col(x).str.count_matches(pl.col('num_ancestral'))).alias(x+'_no_derived_alleles')
+                .otherwise( derived_alleles(x) ).alias(x+'_no_derived_alleles')
             for x in inds
         )
-    # Drops unused columns and exits function
-    [df.drop_in_place(x) for x in inds + ['num_ancestral','REF','ALT']]
-    print(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), "GERP output file and VCF file successfully processed for chromosome", chrom, "from position", start, "to position", end)
-    return df
+
+    # Keeps only the output columns, the query is executed when the result is written
+    return df.select(['#CHROM','POS','ancestral_state','gerp_score', *[x+'_no_derived_alleles' for x in inds]])
+
+def count_derived_alleles_windows(gerp_path, vcf_path, bed_path, out_prefix, threads=os.cpu_count()):
+    # Windows from the bed file (0-based, half-open) as 1-based positions, contig names are always strings (e.g. "1")
+    bed = pl.read_csv(bed_path, separator='\t', has_header=False, comment_prefix='#', columns=[0,1,2], new_columns=['chrom','start','end'], schema_overrides={'chrom':pl.String,'start':pl.Int64,'end':pl.Int64})
+    windows = [(chrom, start+1, end) for chrom, start, end in bed.iter_rows()]
+    # The gerp file is converted to parquet (unless it is tabix-indexed) before the windows are processed in parallel
+    gerp_tabix = os.path.exists(gerp_path + '.tbi')
+    if not gerp_tabix:
+        gerp_parquet(gerp_path)
+
+    # Each thread keeps its own open TabixFiles (a handle can not be shared between threads)
+    local = threading.local()
+    handles = []
+    def process_window(window):
+        chrom, start, end = window
+        if not hasattr(local, 'tbx'):
+            local.tbx = pysam.TabixFile(vcf_path)
+            handles.append(local.tbx)
+            local.gerp_tbx = pysam.TabixFile(gerp_path) if gerp_tabix else None
+            if gerp_tabix:
+                handles.append(local.gerp_tbx)
+        out_path = f"{out_prefix}_{chrom}_{start}_{end}.tsv"
+        count_derived_alleles(gerp_path, vcf_path, chrom, start, end, tbx=local.tbx, gerp_tbx=local.gerp_tbx).sink_csv(out_path, separator='\t', null_value='NaN', batch_size=64*1024)
+        print(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), "Result for chromosome", chrom, "from position", start, "to position", end, "successfully written to", out_path)
+
+    # Polars releases the GIL while running the queries, so windows are processed in parallel
+    try:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(process_window, windows))
+    finally:
+        [tbx.close() for tbx in handles]
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='A Python script to add the number of derived alleles per sample to the gerp output file.')
     parser.add_argument('-g','--gerp', help='GERP Dataframe',required=True)   # gerp output file with ancestral state and gerp score per site
-    parser.add_argument('-v','--vcf', help='VCF Dataframe',required=True)    # VCF file to be merged
-    parser.add_argument('-c','--contig', help='Contig to process',required=True) # contig to be processed
-    parser.add_argument('-s','--start', help='Start position for window',required=True)  # start position for window (1-based)
-    parser.add_argument('-e','--end', help='End position for window',required=True)    # end position for window
-    parser.add_argument('-o','--output', help='Output file path',required=True) # output file path
-    parser.add_argument('-gz','--gzip', help='Boolean to indicate whether vcf file is gunzip compressed or not (default False)',action='store_true')  
+    parser.add_argument('-v','--vcf', help='VCF Dataframe (bgzipped and tabix-indexed)',required=True)    # VCF file to be merged
+    parser.add_argument('-c','--contig', help='Contig to process') # contig to be processed
+    parser.add_argument('-s','--start', help='Start position for window')  # start position for window (1-based)
+    parser.add_argument('-e','--end', help='End position for window')    # end position for window
+    parser.add_argument('-b','--windows-bed', help='BED file with the windows to process (instead of -c, -s and -e)') # windows to be processed in parallel
+    parser.add_argument('-t','--threads', help='Number of windows processed in parallel with --windows-bed (default: number of CPUs)',type=int,default=os.cpu_count())
+    parser.add_argument('-o','--output', help='Output file path (prefix of the output files with --windows-bed)',required=True) # output file path
+    parser.add_argument('-gz','--gzip', help=argparse.SUPPRESS,action='store_true') # no longer used (the vcf file is always bgzipped), kept for existing command lines
 
     args = vars(parser.parse_args())
+    if args['windows_bed']:
+        count_derived_alleles_windows(args['gerp'], args['vcf'], args['windows_bed'], args['output'], threads=args['threads'])
+        parser.exit()
+    if not (args['contig'] and args['start'] and args['end']):
+        parser.error('the following arguments are required: -c/--contig, -s/--start, -e/--end (or -b/--windows-bed)')
+
     # Call the function
-    df = count_derived_alleles(args['gerp'], args['vcf'], args['contig'], int(args['start']), int(args['end']), gzip=args['gzip'])
+    df = count_derived_alleles(args['gerp'], args['vcf'], args['contig'], int(args['start']), int(args['end']))
 
-    # Write the window to file for further processing    
-    df.write_csv(args['output'], separator='\t', null_value='NaN',)
+    # Runs the query and streams the window to file for further processing
+    df.sink_csv(args['output'], separator='\t', null_value='NaN', batch_size=64*1024)
     print(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), "Result for chromosome", args['contig'], "from position", int(args['start']), "to position", int(args['end']), "successfully written to", args['output'])
\ No newline at end of file